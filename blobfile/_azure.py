@@ -12,6 +12,8 @@ import datetime
 import re
 import math
 import concurrent.futures
+import functools
+import xml.etree.ElementTree as ET
 from typing import Any, Mapping, Dict, Optional, Tuple, Sequence, List, Iterator
 
 import xmltodict
@@ -278,9 +280,7 @@ def generate_signed_url(key: Mapping[str, str], url: str) -> Tuple[str, float]:
     )
     string_to_sign = "\n".join(parts_to_sign)
     params["sig"] = base64.b64encode(
-        hmac.digest(
-            base64.b64decode(key["Value"]), string_to_sign.encode("utf8"), "sha256"
-        )
+        hmac.digest(_decode_key(key["Value"]), string_to_sign.encode("utf8"), "sha256")
     ).decode("utf8")
     query = urllib.parse.urlencode({k: v for k, v in params.items() if v != ""})
     # convert to a utc struct_time by replacing the timezone
@@ -350,12 +350,19 @@ def makedirs(ctx: Context, path: str) -> None:
         success_codes=(201, 400),
     )
     resp = execute_api_request(ctx, req)
+    invalidate_stat(ctx, path)
     if resp.status == 400:
         raise Error(
             f"Unable to create directory, account/container does not exist: '{path}'"
         )
 
 
+@functools.lru_cache(maxsize=32)
+def _decode_key(key: str) -> bytes:
+    # the same few keys are used to sign every request, so only decode them once
+    return base64.b64decode(key)
+
+
 def sign_with_shared_key(req: Request, key: str) -> str:
     # https://docs.microsoft.com/en-us/rest/api/storageservices/authorize-with-shared-key
     params_to_sign = []
@@ -405,7 +412,7 @@ def sign_with_shared_key(req: Request, key: str) -> str:
     string_to_sign = "\n".join(parts_to_sign)
 
     signature = base64.b64encode(
-        hmac.digest(base64.b64decode(key), string_to_sign.encode("utf8"), "sha256")
+        hmac.digest(_decode_key(key), string_to_sign.encode("utf8"), "sha256")
     ).decode("utf8")
 
     return f"SharedKey {storage_account}:{signature}"
@@ -416,12 +423,54 @@ def _get_md5(metadata: Mapping[str, Any]) -> Optional[str]:
         b64_encoded = metadata["Content-MD5"]
         if b64_encoded is None:
             return None
-        return base64.b64decode(b64_encoded).hex()
+        return binascii.a2b_base64(b64_encoded).hex()
     else:
         return None
 
 
+_MONTHS = {
+    name: i + 1
+    for i, name in enumerate(
+        [
+            "Jan",
+            "Feb",
+            "Mar",
+            "Apr",
+            "May",
+            "Jun",
+            "Jul",
+            "Aug",
+            "Sep",
+            "Oct",
+            "Nov",
+            "Dec",
+        ]
+    )
+}
+
+
 def _parse_timestamp(text: str) -> float:
+    # timestamps look like "Mon, 01 Jan 2020 00:00:00 GMT", parsing the fields directly is
+    # much faster than strptime(), which is used for anything unexpected
+    parts = text.split(" ")
+    if len(parts) == 6 and parts[5] == "GMT" and parts[2] in _MONTHS:
+        _, day, month, year, hms, _ = parts
+        try:
+            hour, minute, second = hms.split(":")
+            return float(
+                calendar.timegm(
+                    (
+                        int(year),
+                        _MONTHS[month],
+                        int(day),
+                        int(hour),
+                        int(minute),
+                        int(second),
+                    )
+                )
+            )
+        except ValueError:
+            pass
     return datetime.datetime.strptime(
         text.replace("GMT", "Z"), "%a, %d %b %Y %H:%M:%S %z"
     ).timestamp()
@@ -495,7 +544,7 @@ def _get_storage_account_id(
         # we aren't allowed to query this for this subscription, skip it
         return None
 
-    out = json.loads(resp.data)
+    out = common.json_loads(resp.data)
     # check if we found the storage account we are looking for
     for obj in out["value"]:
         if obj["name"] == account:
@@ -520,7 +569,7 @@ def _get_storage_account_key(
         )
 
     resp = common.execute_request(ctx, build_req)
-    result = json.loads(resp.data)
+    result = common.json_loads(resp.data)
     auth = (OAUTH_TOKEN, result["access_token"])
 
     # attempt to use list of subscriptions from the azure cli tool
@@ -545,7 +594,7 @@ def _get_storage_account_key(
             return create_api_request(req, auth=auth)
 
         resp = common.execute_request(ctx, build_req)
-        result = json.loads(resp.data)
+        result = common.json_loads(resp.data)
         unchecked_subscription_ids = [
             item["subscriptionId"]
             for item in result["value"]
@@ -571,7 +620,7 @@ def _get_storage_account_key(
         return create_api_request(req, auth=auth)
 
     resp = common.execute_request(ctx, build_req)
-    result = json.loads(resp.data)
+    result = common.json_loads(resp.data)
     for key in result["keys"]:
         if key["permissions"] == "FULL":
             storage_key_auth = (SHARED_KEY, key["value"])
@@ -610,7 +659,7 @@ def _get_access_token(ctx: Context, key: Any) -> Tuple[Any, float]:
             )
 
         resp = common.execute_request(ctx, build_req)
-        result = json.loads(resp.data)
+        result = common.json_loads(resp.data)
         if resp.status == 400:
             if (
                 (
@@ -655,7 +704,7 @@ def _get_access_token(ctx: Context, key: Any) -> Tuple[Any, float]:
             )
 
         resp = common.execute_request(ctx, build_req)
-        result = json.loads(resp.data)
+        result = common.json_loads(resp.data)
         auth = (OAUTH_TOKEN, result["access_token"])
         if _can_access_container(ctx, account, container, auth):
             return (auth, now + float(result["expires_in"]))
@@ -806,6 +855,7 @@ def _finalize_blob(
         success_codes=(201, 400),
     )
     resp = execute_api_request(ctx, req)
+    invalidate_stat(ctx, path)
     if resp.status == 400:
         result = xmltodict.parse(resp.data)
         if result["Error"]["Code"] == "InvalidBlockList":
@@ -856,11 +906,82 @@ def isdir(ctx: Context, path: str) -> bool:
             ),
         )
         for result in it:
-            if result["Blobs"] is not None:
-                return "BlobPrefix" in result["Blobs"] or "Blob" in result["Blobs"]
+            blobs = result["Blobs"]
+            if blobs["BlobPrefix"] or blobs["Blob"]:
+                return True
         return False
 
 
+def exists(ctx: Context, path: str) -> bool:
+    """
+    Return true if a path is an existing file or directory
+    """
+    account, container, blob = split_path(path)
+    if blob == "" or blob.endswith("/"):
+        return isdir(ctx, path)
+    found, st = ctx.metadata_cache.get(_metadata_cache_key(path))
+    if found and st is not None:
+        return True
+    if not found:
+        # listings are in lexicographic order, so if there is a file with this exact name it
+        # will be the first result, followed by anything else with the name as a prefix
+        it = create_page_iterator(
+            ctx,
+            url=build_url(account, "/{container}", container=container),
+            method="GET",
+            params=dict(
+                comp="list",
+                restype="container",
+                prefix=blob,
+                delimiter="/",
+                maxresults="1",
+            ),
+        )
+        for result in it:
+            blobs = result["Blobs"]
+            names = [item["Name"] for item in blobs["Blob"] + blobs["BlobPrefix"]]
+            if not names:
+                continue
+            if blob in names:
+                return True
+            ctx.metadata_cache.put(_metadata_cache_key(path), None)
+            if blob + "/" in names:
+                return True
+            break
+        else:
+            # nothing has this name as a prefix
+            ctx.metadata_cache.put(_metadata_cache_key(path), None)
+            return False
+    # something like "name.txt" sorts before "name/", so check for the directory separately
+    return isdir(ctx, path)
+
+
+def _parse_listing(data: bytes) -> Dict[str, Any]:
+    """
+    Parse a "List Blobs" response into the subset of fields that we use
+
+    This uses ElementTree rather than xmltodict because it builds the tree in C, which
+    matters for listing pages with thousands of entries.  "Blob" and "BlobPrefix" are
+    always lists, even when there are zero or one of them.
+    """
+    root = ET.fromstring(data)
+    blobs: Dict[str, List[Dict[str, Any]]] = {"Blob": [], "BlobPrefix": []}
+    blobs_elem = root.find("Blobs")
+    if blobs_elem is not None:
+        for elem in blobs_elem:
+            if elem.tag == "Blob":
+                props_elem = elem.find("Properties")
+                props = {}
+                if props_elem is not None:
+                    props = {p.tag: p.text for p in props_elem}
+                blobs["Blob"].append(
+                    {"Name": elem.findtext("Name"), "Properties": props}
+                )
+            elif elem.tag == "BlobPrefix":
+                blobs["BlobPrefix"].append({"Name": elem.findtext("Name")})
+    return {"Blobs": blobs, "NextMarker": root.findtext("NextMarker") or None}
+
+
 def create_page_iterator(
     ctx: Context,
     url: str,
@@ -887,7 +1008,7 @@ def create_page_iterator(
         resp = execute_api_request(ctx, req)
         if resp.status in (404, INVALID_HOSTNAME_STATUS):
             return
-        result = xmltodict.parse(resp.data)["EnumerationResults"]
+        result = _parse_listing(resp.data)
         yield result
         if result["NextMarker"] is None:
             break
@@ -1031,9 +1152,36 @@ class StreamingWriteFile(BaseStreamingWriteFile):
                 f"No such file or container/account does not exist: '{path}'"
             )
         self._md5 = hashlib.md5()
+        # blocks can be put in any order, so we upload them from a thread pool and only wait
+        # for them to finish before putting the block list
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._futures: List["concurrent.futures.Future[urllib3.HTTPResponse]"] = []
         super().__init__(ctx=ctx, chunk_size=ctx.azure_write_chunk_size)
 
+    def _put_block(self, req: Request) -> None:
+        max_workers = self._ctx.azure_upload_concurrency
+        if max_workers <= 1:
+            execute_api_request(self._ctx, req)
+            return
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers
+            )
+        # each pending block holds onto its data, so limit the number of blocks in flight
+        while len(self._futures) >= max_workers:
+            self._futures.pop(0).result()
+        self._futures.append(self._executor.submit(execute_api_request, self._ctx, req))
+
+    def _wait_for_blocks(self) -> None:
+        futures = self._futures
+        self._futures = []
+        for future in futures:
+            future.result()
+
     def _upload_chunk(self, chunk: bytes, finalize: bool) -> None:
+        # slicing a memoryview shares the chunk's memory instead of copying each block
+        view = memoryview(chunk)
         start = 0
         while start < len(chunk):
             # premium block blob storage supports block blobs and append blobs
@@ -1041,7 +1189,7 @@ class StreamingWriteFile(BaseStreamingWriteFile):
             # we use block blobs because they are compatible with WASB:
             # https://docs.microsoft.com/en-us/azure/databricks/kb/data-sources/wasb-check-blob-types
             end = start + self._ctx.azure_write_chunk_size
-            data = chunk[start:end]
+            data = view[start:end]
             self._md5.update(data)
             req = Request(
                 url=self._url,
@@ -1055,7 +1203,7 @@ class StreamingWriteFile(BaseStreamingWriteFile):
                 data=data,
                 success_codes=(201,),
             )
-            execute_api_request(self._ctx, req)
+            self._put_block(req)
             self._block_index += 1
             if self._block_index >= BLOCK_COUNT_LIMIT:
                 raise Error(
@@ -1065,6 +1213,7 @@ class StreamingWriteFile(BaseStreamingWriteFile):
             start += self._ctx.azure_write_chunk_size
 
         if finalize:
+            self._wait_for_blocks()
             block_ids = [
                 _block_index_to_block_id(i, self._upload_id)
                 for i in range(self._block_index)
@@ -1077,6 +1226,15 @@ class StreamingWriteFile(BaseStreamingWriteFile):
                 md5_digest=self._md5.digest(),
             )
 
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            executor = getattr(self, "_executor", None)
+            if executor is not None:
+                executor.shutdown(wait=False)
+                self._executor = None
+
 
 def _upload_chunk(
     ctx: Context, path: str, start: int, size: int, url: str, block_id: str
@@ -1124,7 +1282,7 @@ def parallel_upload(
             ctx,
             src,
             start,
-            min(ctx.azure_write_chunk_size, s.st_size - start),
+            min(part_size, s.st_size - start),
             dst_url,
             block_id,
         )
@@ -1141,19 +1299,34 @@ def parallel_upload(
     return binascii.hexlify(md5_digest).decode("utf8") if return_md5 else None
 
 
+def _metadata_cache_key(path: str) -> Tuple[str, ...]:
+    account, container, blob = split_path(path)
+    return ("az", account, container, blob)
+
+
+def invalidate_stat(ctx: Context, path: str) -> None:
+    ctx.metadata_cache.invalidate(_metadata_cache_key(path))
+
+
 def maybe_stat(ctx: Context, path: str) -> Optional[Stat]:
     account, container, blob = split_path(path)
     if blob == "":
         return None
+    key = _metadata_cache_key(path)
+    found, st = ctx.metadata_cache.get(key)
+    if found:
+        return st
     req = Request(
         url=build_url(account, "/{container}/{blob}", container=container, blob=blob),
         method="HEAD",
         success_codes=(200, 404, INVALID_HOSTNAME_STATUS),
     )
     resp = execute_api_request(ctx, req)
-    if resp.status != 200:
-        return None
-    return make_stat(resp.headers)
+    st = None
+    if resp.status == 200:
+        st = make_stat(resp.headers)
+    ctx.metadata_cache.put(key, st)
+    return st
 
 
 def remove(ctx: Context, path: str) -> bool:
@@ -1166,6 +1339,7 @@ def remove(ctx: Context, path: str) -> bool:
         success_codes=(202, 404, INVALID_HOSTNAME_STATUS),
     )
     resp = execute_api_request(ctx, req)
+    invalidate_stat(ctx, path)
     return resp.status == 202
 
 
@@ -1203,6 +1377,7 @@ def maybe_update_md5(ctx: Context, path: str, etag: str, hexdigest: str) -> bool
         success_codes=(200, 404, 412),
     )
     resp = execute_api_request(ctx, req)
+    invalidate_stat(ctx, path)
     return resp.status == 200
 
 
@@ -9,6 +9,9 @@ import threading
 import ssl
 import socket
 import platform
+import concurrent.futures
+import collections
+import weakref
 from typing import (
     Callable,
     Dict,
@@ -24,28 +27,45 @@ from typing import (
 import urllib3
 import xmltodict
 
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
 # feature flags
 USE_STREAMING_READ_REQUEST = True
 
 CHUNK_SIZE = 2 ** 20
+# a short forward seek on a streaming read discards data from the open response
+# instead of making a new request, this is the largest seek that is handled this way
+STREAMING_READ_SKIP_SIZE = 2 ** 20
 
 PARALLEL_COPY_MINIMUM_PART_SIZE = 32 * 2 ** 20
 
+# number of blocks copy() can read ahead of the blocks it has written
+COPY_WRITE_BEHIND_BLOCKS = 4
+
 EARLY_EXPIRATION_SECONDS = 5 * 60
 
 INVALID_HOSTNAME_STATUS = 600  # fake status for invalid hostname
 
 DEFAULT_CONNECTION_POOL_MAX_SIZE = 32
 DEFAULT_MAX_CONNECTION_POOL_COUNT = 10
-DEFAULT_AZURE_WRITE_CHUNK_SIZE = 8 * 2 ** 20
+DEFAULT_AZURE_WRITE_CHUNK_SIZE = 50 * 2 ** 20
+DEFAULT_AZURE_UPLOAD_CONCURRENCY = 4
 DEFAULT_GOOGLE_WRITE_CHUNK_SIZE = 8 * 2 ** 20
 DEFAULT_RETRY_LOG_THRESHOLD = 0
 DEFAULT_CONNECT_TIMEOUT = 10
 DEFAULT_READ_TIMEOUT = 30
+DEFAULT_READ_CONCURRENCY = 1
+DEFAULT_PARALLEL_READ_CHUNK_SIZE = 4 * 2 ** 20
+DEFAULT_METADATA_CACHE_SIZE = 0
 
 BACKOFF_INITIAL = 0.1
 BACKOFF_MAX = 60.0
-BACKOFF_JITTER_FRACTION = 0.5
+# full jitter, sleep a random fraction of the current backoff so that clients that
+# failed at the same time do not retry at the same time
+BACKOFF_JITTER_FRACTION = 1.0
 
 HOSTNAME_EXISTS = 0
 HOSTNAME_DOES_NOT_EXIST = 1
@@ -132,6 +152,16 @@ class Error(Exception):
         super().__init__(message, *args)
 
 
+def json_loads(data: bytes) -> Any:
+    """
+    Parse a JSON response body, using orjson if it is installed since it is much faster
+    than the json module on large listing pages
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 def _extract_error(data: bytes) -> Tuple[Optional[str], Optional[str]]:
     if data.startswith(b"\xef\xbb\xbf<?xml"):
         try:
@@ -230,6 +260,64 @@ class DirEntry(NamedTuple):
     stat: Optional[Stat]
 
 
+class MetadataCache:
+    """
+    A thread-safe LRU cache of `Stat` results for remote paths, a cached value of `None`
+    records that there was no blob at that path
+
+    If `ttl` is not None, entries are only returned for `ttl` seconds after they are stored
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        # map of key to (expiration time, stat)
+        self._entries: "collections.OrderedDict[Tuple[str, ...], Tuple[Optional[float], Optional[Stat]]]" = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, ...]) -> Tuple[bool, Optional[Stat]]:
+        """
+        Returns a tuple of (found, stat)
+        """
+        with self._lock:
+            if key not in self._entries:
+                return False, None
+            expiration, st = self._entries[key]
+            if expiration is not None and time.monotonic() >= expiration:
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, st
+
+    def put(self, key: Tuple[str, ...], st: Optional[Stat]) -> None:
+        if self._maxsize <= 0:
+            return
+        expiration = None
+        if self._ttl is not None:
+            expiration = time.monotonic() + self._ttl
+        with self._lock:
+            self._entries[key] = (expiration, st)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Tuple[str, ...]) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    # each process gets an empty cache, the lock cannot be pickled
+    def __getstate__(self) -> Dict[str, Any]:
+        return {"maxsize": self._maxsize, "ttl": self._ttl}
+
+    def __setstate__(self, state: Any) -> None:
+        self.__init__(maxsize=state["maxsize"], ttl=state["ttl"])
+
+
 def default_log_fn(msg: str) -> None:
     print(f"blobfile: {msg}")
 
@@ -243,6 +331,7 @@ class Context:
         # https://docs.microsoft.com/en-us/rest/api/storageservices/understanding-block-blobs--append-blobs--and-page-blobs#about-block-blobs
         # the chunk size determines the maximum size of an individual blob
         azure_write_chunk_size: int = DEFAULT_AZURE_WRITE_CHUNK_SIZE,
+        azure_upload_concurrency: int = DEFAULT_AZURE_UPLOAD_CONCURRENCY,
         google_write_chunk_size: int = DEFAULT_GOOGLE_WRITE_CHUNK_SIZE,
         retry_log_threshold: int = DEFAULT_RETRY_LOG_THRESHOLD,
         retry_limit: Optional[int] = None,
@@ -250,11 +339,16 @@ class Context:
         read_timeout: Optional[int] = DEFAULT_READ_TIMEOUT,
         output_az_paths: bool = False,
         use_azure_storage_account_key_fallback: bool = True,
+        metadata_cache_size: int = DEFAULT_METADATA_CACHE_SIZE,
+        metadata_cache_ttl: Optional[float] = None,
+        read_concurrency: int = DEFAULT_READ_CONCURRENCY,
+        parallel_read_chunk_size: int = DEFAULT_PARALLEL_READ_CHUNK_SIZE,
     ) -> None:
         self.log_callback = log_callback
         self.connection_pool_max_size = connection_pool_max_size
         self.max_connection_pool_count = max_connection_pool_count
         self.azure_write_chunk_size = azure_write_chunk_size
+        self.azure_upload_concurrency = azure_upload_concurrency
         self.retry_log_threshold = retry_log_threshold
         self.retry_limit = retry_limit
         self.google_write_chunk_size = google_write_chunk_size
@@ -264,7 +358,18 @@ class Context:
         self.use_azure_storage_account_key_fallback = (
             use_azure_storage_account_key_fallback
         )
+        self.metadata_cache = MetadataCache(
+            maxsize=metadata_cache_size, ttl=metadata_cache_ttl
+        )
+        self.read_concurrency = read_concurrency
+        self.parallel_read_chunk_size = parallel_read_chunk_size
+
+        self._reset_http_pool()
+        _contexts.add(self)
 
+    def _reset_http_pool(self) -> None:
+        # another thread may have been holding the lock when the process forked, in which
+        # case it will never be released in the child
         self.http = None
         self.http_pid = None
         self.http_lock = threading.Lock()
@@ -273,6 +378,10 @@ class Context:
         # ssl is not fork safe https://docs.python.org/2/library/ssl.html#multi-processing
         # urllib3 may not be fork safe https://github.com/urllib3/urllib3/issues/1179
         # both are supposedly threadsafe though, so we shouldn't need a thread-local pool
+        http = self.http
+        if http is not None and self.http_pid == os.getpid():
+            # every request gets the pool, so don't take the lock once it exists
+            return http
         with self.http_lock:
             if self.http is None or self.http_pid != os.getpid():
                 # tensorflow imports requests which calls
@@ -302,14 +411,17 @@ class Context:
                     ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_COMPRESSION
                 )
                 context.load_default_certs()
-                self.http_pid = os.getpid()
-                self.http = urllib3.PoolManager(
+                http = urllib3.PoolManager(
                     ssl_context=context,
                     maxsize=self.connection_pool_max_size,
                     num_pools=self.max_connection_pool_count,
                 )
                 # for debugging with mitmproxy
-                # self.http = urllib3.ProxyManager('http://localhost:8080/', ssl_context=context)
+                # http = urllib3.ProxyManager('http://localhost:8080/', ssl_context=context)
+                # the lock-free check above reads these without the lock, so only set the pid
+                # once the pool for this process is in place
+                self.http = http
+                self.http_pid = os.getpid()
         return self.http
 
     # we don't want to serialize locks or other unpicklable objects
@@ -322,6 +434,19 @@ class Context:
         self.__dict__.update(state)
 
 
+_contexts: "weakref.WeakSet[Context]" = weakref.WeakSet()
+
+
+def _reset_http_pools_after_fork() -> None:
+    for ctx in list(_contexts):
+        ctx._reset_http_pool()
+
+
+# the pid check in get_http_pool() also handles this, but only when the lock is free
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_http_pools_after_fork)
+
+
 class WindowedFile:
     """
     A file object that reads from a window into a file
@@ -497,30 +622,52 @@ class TokenManager:
         self, get_token_fn: Callable[[Context, Any], Tuple[Any, float]]
     ) -> None:
         self._get_token_fn = get_token_fn
-        self._tokens = {}
-        self._expirations = {}
+        # map of key to (token, expiration), the tuple is replaced as a whole so that it can be
+        # read without holding a lock
+        self._tokens: Dict[Any, Tuple[Any, float]] = {}
+        self._key_locks: Dict[Any, threading.Lock] = {}
         self._lock = threading.Lock()
 
+    def _get_valid_token(self, key: Any) -> Tuple[bool, Any]:
+        entry = self._tokens.get(key)
+        if entry is None:
+            return False, None
+        token, expiration = entry
+        if time.time() + EARLY_EXPIRATION_SECONDS > expiration:
+            return False, None
+        return True, token
+
     def get_token(self, ctx: Context, key: Any) -> Any:
+        valid, token = self._get_valid_token(key)
+        if valid:
+            return token
+
         with self._lock:
-            now = time.time()
-            expiration = self._expirations.get(key)
-            if expiration is None or (now + EARLY_EXPIRATION_SECONDS) > expiration:
-                self._tokens[key], self._expirations[key] = self._get_token_fn(ctx, key)
-                assert self._expirations[key] is not None
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            key_lock = self._key_locks[key]
 
-            assert key in self._tokens
-            return self._tokens[key]
+        # only requests for the same key wait on each other while the token is fetched
+        with key_lock:
+            valid, token = self._get_valid_token(key)
+            if valid:
+                return token
+            token, expiration = self._get_token_fn(ctx, key)
+            assert expiration is not None
+            self._tokens[key] = (token, expiration)
+            return token
 
 
 class BaseStreamingWriteFile(io.BufferedIOBase):
     def __init__(self, ctx: Context, chunk_size: int) -> None:
         # current writing byte offset in the file
         self._offset = 0
-        # contents waiting to be uploaded
-        self._buf = b""
+        # contents waiting to be uploaded, appending to a bytes object would copy the
+        # whole buffer on every write
+        self._buf = bytearray()
         self._chunk_size = chunk_size
         self._ctx = ctx
+        self._discarded = False
 
     def _upload_chunk(self, chunk: bytes, finalize: bool) -> None:
         raise NotImplementedError
@@ -531,8 +678,11 @@ class BaseStreamingWriteFile(io.BufferedIOBase):
         else:
             size = (len(self._buf) // self._chunk_size) * self._chunk_size
             assert size > 0
-        chunk = self._buf[:size]
-        self._buf = self._buf[size:]
+        # hand the existing buffer to the upload and copy only the remainder, which is
+        # usually much smaller than the chunk
+        chunk = self._buf
+        self._buf = chunk[size:]
+        del chunk[size:]
 
         self._upload_chunk(chunk, finalize)
         self._offset += len(chunk)
@@ -541,21 +691,35 @@ class BaseStreamingWriteFile(io.BufferedIOBase):
         if self.closed:
             return
 
-        # we will have a partial remaining buffer at this point
-        self._upload_buf(finalize=True)
+        if not self._discarded:
+            # we will have a partial remaining buffer at this point
+            self._upload_buf(finalize=True)
         super().close()
 
+    def discard(self) -> None:
+        """
+        Close the file without finishing the upload, none of the written data is committed
+        """
+        self._discarded = True
+        self._buf = bytearray()
+        self.close()
+
     def tell(self) -> int:
         return self._offset
 
     def writable(self) -> bool:
         return True
 
-    def write(self, b: bytes) -> int:
-        self._buf += b
+    def write(self, b: Any) -> int:
+        # b can be any object supporting the buffer protocol, the number of bytes is not
+        # len(b) for multi-dimensional or non-byte views such as a numpy frame, and appending
+        # a numpy array directly would go through its __radd__, so use a flat byte view
+        data = memoryview(b).cast("B")
+        self._buf += data
+        nbytes = len(data)
         while len(self._buf) > self._chunk_size:
             self._upload_buf()
-        return len(b)
+        return nbytes
 
     def readinto(self, b: Any) -> int:
         raise io.UnsupportedOperation("not readable")
@@ -579,6 +743,10 @@ class BaseStreamingReadFile(io.RawIOBase):
         # current reading byte offset in the file
         self._offset = 0
         self._f = None
+        # when read_concurrency > 1, ranged requests for chunks of the file at and ahead of
+        # the current offset, keyed by chunk index
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._chunks: Dict[int, "concurrent.futures.Future[bytes]"] = {}
         self.requests = 0
         self.failures = 0
         self.bytes_read = 0
@@ -595,11 +763,12 @@ class BaseStreamingReadFile(io.RawIOBase):
         # cannot be retried without re-reading the entire requested amount
         # instead, read into a buffer and return the buffer
         pieces = []
+        piece_size = get_read_block_size(self._ctx)
         while True:
             bytes_remaining = self._size - self._offset
             assert bytes_remaining >= 0, "read more bytes than expected"
             # if a user doesn't like this value, it is easy to use .read(size) directly
-            opt_piece = self.read(min(CHUNK_SIZE, bytes_remaining))
+            opt_piece = self.read(min(piece_size, bytes_remaining))
             assert opt_piece is not None, "file is in non-blocking mode"
             piece = opt_piece
             if len(piece) == 0:
@@ -618,7 +787,9 @@ class BaseStreamingReadFile(io.RawIOBase):
             b = b[:bytes_remaining]
 
         n = 0  # for pyright
-        if USE_STREAMING_READ_REQUEST:
+        if self._ctx.read_concurrency > 1:
+            n = self._readahead_readinto(b)
+        elif USE_STREAMING_READ_REQUEST:
             for attempt, backoff in enumerate(exponential_sleep_generator()):
                 if self._f is None:
                     resp = self._request_chunk(streaming=True, start=self._offset)
@@ -684,6 +855,80 @@ class BaseStreamingReadFile(io.RawIOBase):
         self._offset += n
         return n
 
+    def _fetch_chunk(self, index: int) -> bytes:
+        chunk_size = self._ctx.parallel_read_chunk_size
+        start = index * chunk_size
+        end = min(start + chunk_size, self._size)
+        # the body is read here rather than inside the request so that a connection that
+        # dies partway through is retried the same way as in the sequential path
+        for attempt, backoff in enumerate(exponential_sleep_generator()):
+            resp = self._request_chunk(streaming=True, start=start, end=end)
+            if resp.status == 416:
+                # likely the file was truncated while we were reading it
+                return b""
+            try:
+                return resp.data[: end - start]
+            except (
+                urllib3.exceptions.ReadTimeoutError,
+                urllib3.exceptions.ProtocolError,
+                urllib3.exceptions.SSLError,
+                ssl.SSLError,
+            ) as e:
+                err = Error(f"exception {e} while reading file at {self._path}")
+            # don't put a broken connection back in the pool
+            resp.close()
+            self.failures += 1
+
+            if self._ctx.retry_limit is not None and attempt >= self._ctx.retry_limit:
+                raise err
+
+            if attempt >= self._ctx.retry_log_threshold:
+                self._ctx.log_callback(
+                    f"error {err} when reading chunk {index} at offset {start} attempt {attempt}, sleeping for {backoff:.1f} seconds before retrying"
+                )
+            time.sleep(backoff)
+        assert False, "unreachable"
+
+    def _readahead_readinto(self, b: Any) -> int:
+        # a single connection is often limited by latency rather than bandwidth, so read
+        # the file in fixed size chunks and keep requests for the next few chunks in flight
+        # while the caller consumes the current one
+        buf = memoryview(b).cast("B")
+        chunk_size = self._ctx.parallel_read_chunk_size
+        window = self._ctx.read_concurrency
+        last_index = (self._size - 1) // chunk_size
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=window)
+
+        n = 0
+        while n < len(buf):
+            offset = self._offset + n
+            index = offset // chunk_size
+            # drop chunks outside of the window, for instance ones we already read or
+            # ones that are no longer ahead of us after a seek
+            for i in list(self._chunks):
+                if not index <= i < index + window:
+                    self._chunks.pop(i).cancel()
+            for i in range(index, min(index + window, last_index + 1)):
+                if i not in self._chunks:
+                    self._chunks[i] = self._executor.submit(self._fetch_chunk, i)
+                    self.requests += 1
+
+            try:
+                data = self._chunks[index].result()
+            except BaseException:
+                # don't keep the failed request around, so that the next read retries it
+                self._chunks.pop(index, None)
+                raise
+            pos = offset - index * chunk_size
+            size = min(len(data) - pos, len(buf) - n)
+            if size <= 0:
+                # the file was truncated, only return the data before that
+                break
+            buf[n : n + size] = data[pos : pos + size]
+            n += size
+        return n
+
     def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
         if whence == io.SEEK_SET:
             new_offset = offset
@@ -696,12 +941,34 @@ class BaseStreamingReadFile(io.RawIOBase):
                 f"Invalid whence ({whence}, should be {io.SEEK_SET}, {io.SEEK_CUR}, or {io.SEEK_END})"
             )
         if new_offset != self._offset:
+            skip = new_offset - self._offset
             self._offset = new_offset
             if self._f is not None:
+                if 0 < skip <= STREAMING_READ_SKIP_SIZE and self._skip(skip):
+                    return self._offset
                 self._f.close()
             self._f = None
         return self._offset
 
+    def _skip(self, n: int) -> bool:
+        # read and discard data from the open response, this is usually faster than waiting
+        # for a new request, returns False if the response could not be used
+        assert self._f is not None
+        try:
+            while n > 0:
+                data = self._f.read(min(n, CHUNK_SIZE))
+                if len(data) == 0:
+                    return False
+                n -= len(data)
+        except (
+            urllib3.exceptions.ReadTimeoutError,
+            urllib3.exceptions.ProtocolError,
+            urllib3.exceptions.SSLError,
+            ssl.SSLError,
+        ):
+            return False
+        return True
+
     def tell(self) -> int:
         return self._offset
 
@@ -717,6 +984,13 @@ class BaseStreamingReadFile(io.RawIOBase):
             self._f.close()
             self._f = None
 
+        if getattr(self, "_executor", None) is not None:
+            for future in self._chunks.values():
+                future.cancel()
+            self._chunks = {}
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
         super().close()
 
     def readable(self) -> bool:
@@ -726,14 +1000,27 @@ class BaseStreamingReadFile(io.RawIOBase):
         return True
 
 
+def get_read_block_size(ctx: Context) -> int:
+    """
+    Size of reads from a streaming file that are large enough to be split across
+    all of the parallel ranged requests, if those are enabled
+    """
+    if ctx.read_concurrency > 1:
+        return max(CHUNK_SIZE, ctx.read_concurrency * ctx.parallel_read_chunk_size)
+    return CHUNK_SIZE
+
+
 # this should by BinaryIO, but that produces an error error: Argument of type 'IO[Any]' cannot be assigned to parameter 'f' of type 'BinaryIO' when used with open()
-def block_md5(f: Any) -> bytes:
+def block_md5(f: Any, block_size: int = CHUNK_SIZE) -> bytes:
     m = hashlib.md5()
+    # read into the same buffer each time instead of allocating a new bytes object per block
+    buf = bytearray(block_size)
+    view = memoryview(buf)
     while True:
-        block = f.read(CHUNK_SIZE)
-        if block == b"":
+        n = f.readinto(buf)
+        if not n:
             break
-        m.update(block)
+        m.update(view[:n])
     return m.digest()
 
 
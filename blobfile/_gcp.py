@@ -34,6 +34,11 @@ from blobfile._common import (
 
 MAX_EXPIRATION = 7 * 24 * 60 * 60
 
+# only request the fields of each listed object that make_stat() uses, the full object
+# resource includes acls, owners, storage class, etc.
+# https://cloud.google.com/storage/docs/json_api#partial-response
+LIST_FIELDS = "items(name,size,updated,timeCreated,md5Hash,generation,metadata),prefixes,nextPageToken"
+
 
 def _is_gce_instance() -> bool:
     try:
@@ -298,16 +303,65 @@ def isdir(ctx: Context, path: str) -> bool:
         req = Request(
             url=build_url("/storage/v1/b/{bucket}/o", bucket=bucket),
             method="GET",
-            params=dict(prefix=blob, delimiter="/", maxResults="1"),
+            params=dict(
+                prefix=blob,
+                delimiter="/",
+                maxResults="1",
+                fields="items(name),prefixes",
+            ),
             success_codes=(200, 404),
         )
         resp = execute_api_request(ctx, req)
         if resp.status == 404:
             return False
-        result = json.loads(resp.data)
+        result = common.json_loads(resp.data)
         return "items" in result or "prefixes" in result
 
 
+def exists(ctx: Context, path: str) -> bool:
+    """
+    Return true if a path is an existing file or directory
+    """
+    bucket, blob = split_path(path)
+    if blob == "" or blob.endswith("/"):
+        return isdir(ctx, path)
+    found, st = ctx.metadata_cache.get(_metadata_cache_key(path))
+    if found and st is not None:
+        return True
+    if not found:
+        # listings are in lexicographic order, so if there is a file with this exact name it
+        # will be the first result, followed by anything else with the name as a prefix
+        req = Request(
+            url=build_url("/storage/v1/b/{bucket}/o", bucket=bucket),
+            method="GET",
+            params=dict(prefix=blob, delimiter="/", maxResults="1", fields=LIST_FIELDS),
+            success_codes=(200, 403, 404),
+        )
+        resp = execute_api_request(ctx, req)
+        if resp.status == 404:
+            return False
+        if resp.status == 403:
+            # the caller may be allowed to read objects without being allowed to list them
+            return maybe_stat(ctx, path) is not None or isdir(ctx, path)
+        result = common.json_loads(resp.data)
+        if "items" not in result and "prefixes" not in result:
+            if "nextPageToken" not in result:
+                # nothing has this name as a prefix
+                cache_stat(ctx, path, None)
+                return False
+            # a page can come back empty while more results remain, which tells us nothing
+            return maybe_stat(ctx, path) is not None or isdir(ctx, path)
+        for item in result.get("items", []):
+            if item["name"] == blob:
+                cache_stat(ctx, path, make_stat(item))
+                return True
+        cache_stat(ctx, path, None)
+        if blob + "/" in result.get("prefixes", []):
+            return True
+    # something like "name.txt" sorts before "name/", so check for the directory separately
+    return isdir(ctx, path)
+
+
 def makedirs(ctx: Context, path: str) -> None:
     """
     Make any directories necessary to ensure that path is a directory
@@ -322,6 +376,7 @@ def makedirs(ctx: Context, path: str) -> None:
         success_codes=(200, 400),
     )
     resp = execute_api_request(ctx, req)
+    invalidate_stat(ctx, path)
     if resp.status == 400:
         raise Error(f"Unable to create directory, bucket does not exist: '{path}'")
 
@@ -342,7 +397,7 @@ def combine_path(bucket: str, obj: str) -> str:
 
 def get_md5(metadata: Mapping[str, Any]) -> Optional[str]:
     if "md5Hash" in metadata:
-        return base64.b64decode(metadata["md5Hash"]).hex()
+        return binascii.a2b_base64(metadata["md5Hash"]).hex()
 
     if "metadata" in metadata and "md5" in metadata["metadata"]:
         # fallback to our custom hash if this is a composite object that is lacking the md5Hash field
@@ -352,6 +407,13 @@ def get_md5(metadata: Mapping[str, Any]) -> Optional[str]:
 
 
 def _parse_timestamp(text: str) -> float:
+    # timestamps look like "2020-01-02T03:04:05.678Z", fromisoformat() is much faster than
+    # strptime() but does not accept the "Z" suffix or all fraction lengths before 3.11
+    if text.endswith("Z"):
+        try:
+            return datetime.datetime.fromisoformat(text[:-1] + "+00:00").timestamp()
+        except ValueError:
+            pass
     return datetime.datetime.strptime(text, "%Y-%m-%dT%H:%M:%S.%f%z").timestamp()
 
 
@@ -384,7 +446,7 @@ def _get_access_token(ctx: Context, key: Any) -> Tuple[Any, float]:
             return req
 
         resp = common.execute_request(ctx, build_req)
-        result = json.loads(resp.data)
+        result = common.json_loads(resp.data)
         if resp.status == 400:
             error = result["error"]
             description = result.get("error_description", "<missing description>")
@@ -409,7 +471,7 @@ def _get_access_token(ctx: Context, key: Any) -> Tuple[Any, float]:
             )
 
         resp = common.execute_request(ctx, build_req)
-        result = json.loads(resp.data)
+        result = common.json_loads(resp.data)
         return result["access_token"], now + float(result["expires_in"])
     else:
         raise Error(err)
@@ -450,6 +512,7 @@ class StreamingReadFile(BaseStreamingReadFile):
 
 class StreamingWriteFile(BaseStreamingWriteFile):
     def __init__(self, ctx: Context, path: str) -> None:
+        self._path = path
         bucket, name = split_path(path)
         req = Request(
             url=build_url(
@@ -494,7 +557,12 @@ class StreamingWriteFile(BaseStreamingWriteFile):
         )
 
         try:
-            execute_api_request(self._ctx, req)
+            resp = execute_api_request(self._ctx, req)
+            if finalize:
+                # the response is the resource for the new object
+                cache_stat(
+                    self._ctx, self._path, make_stat(common.json_loads(resp.data))
+                )
         except RequestFailure as e:
             # https://cloud.google.com/storage/docs/resumable-uploads#practices
             if e.response_status in (404, 410):
@@ -509,19 +577,38 @@ class StreamingWriteFile(BaseStreamingWriteFile):
                 raise
 
 
+def _metadata_cache_key(path: str) -> Tuple[str, ...]:
+    bucket, blob = split_path(path)
+    return ("gs", bucket, blob)
+
+
+def invalidate_stat(ctx: Context, path: str) -> None:
+    ctx.metadata_cache.invalidate(_metadata_cache_key(path))
+
+
+def cache_stat(ctx: Context, path: str, st: Optional[Stat]) -> None:
+    ctx.metadata_cache.put(_metadata_cache_key(path), st)
+
+
 def maybe_stat(ctx: Context, path: str) -> Optional[Stat]:
     bucket, blob = split_path(path)
     if blob == "":
         return None
+    key = _metadata_cache_key(path)
+    found, st = ctx.metadata_cache.get(key)
+    if found:
+        return st
     req = Request(
         url=build_url("/storage/v1/b/{bucket}/o/{object}", bucket=bucket, object=blob),
         method="GET",
         success_codes=(200, 404),
     )
     resp = execute_api_request(ctx, req)
-    if resp.status != 200:
-        return None
-    return make_stat(json.loads(resp.data))
+    st = None
+    if resp.status == 200:
+        st = make_stat(common.json_loads(resp.data))
+    ctx.metadata_cache.put(key, st)
+    return st
 
 
 def remove(ctx: Context, path: str) -> bool:
@@ -534,6 +621,7 @@ def remove(ctx: Context, path: str) -> bool:
         success_codes=(204, 404),
     )
     resp = execute_api_request(ctx, req)
+    invalidate_stat(ctx, path)
     return resp.status == 204
 
 
@@ -549,9 +637,33 @@ def maybe_update_md5(ctx: Context, path: str, generation: str, hexdigest: str) -
     )
 
     resp = execute_api_request(ctx, req)
+    if resp.status == 200:
+        cache_stat(ctx, path, make_stat(common.json_loads(resp.data)))
+    else:
+        invalidate_stat(ctx, path)
     return resp.status == 200
 
 
+def upload_file(ctx: Context, src: str, dst: str) -> Optional[str]:
+    """
+    Upload a local file with a single request, returns the md5 of the new object
+    """
+    bucket, blob = split_path(dst)
+    req = Request(
+        url=build_url("/upload/storage/v1/b/{bucket}/o", bucket=bucket),
+        method="POST",
+        params=dict(uploadType="media", name=blob),
+        data=FileBody(src, start=0, end=os.path.getsize(src)),
+        success_codes=(200, 400, 404),
+    )
+    resp = execute_api_request(ctx, req)
+    if resp.status in (400, 404):
+        raise FileNotFoundError(f"No such file or bucket: '{dst}'")
+    metadata = common.json_loads(resp.data)
+    cache_stat(ctx, dst, make_stat(metadata))
+    return get_md5(metadata)
+
+
 def _upload_part(ctx: Context, path: str, start: int, size: int, dst: str) -> str:
     bucket, blob = split_path(dst)
     req = Request(
@@ -562,7 +674,7 @@ def _upload_part(ctx: Context, path: str, start: int, size: int, dst: str) -> st
         success_codes=(200,),
     )
     resp = execute_api_request(ctx, req)
-    metadata = json.loads(resp.data)
+    metadata = common.json_loads(resp.data)
     return metadata["generation"]
 
 
@@ -632,7 +744,7 @@ def parallel_upload(
         success_codes=(200,),
     )
     resp = execute_api_request(ctx, req)
-    metadata = json.loads(resp.data)
+    metadata = common.json_loads(resp.data)
     hexdigest = binascii.hexlify(md5_digest).decode("utf8")
     maybe_update_md5(ctx, dst, metadata["generation"], hexdigest)
 
@@ -3,6 +3,8 @@ from __future__ import annotations
 
 import os
 import tempfile
+import atexit
+import uuid
 import hashlib
 import io
 import urllib.parse
@@ -15,9 +17,12 @@ import re
 import shutil
 import collections
 import itertools
+import functools
 import math
 import concurrent.futures
 import multiprocessing as mp
+import queue
+import threading
 from types import ModuleType
 from typing import (
     overload,
@@ -34,6 +39,7 @@ from typing import (
     cast,
     NamedTuple,
     List,
+    Pattern,
     Union,
     TYPE_CHECKING,
 )
@@ -60,15 +66,42 @@ from blobfile._common import (
 
 # https://cloud.google.com/storage/docs/naming
 # https://www.w3.org/TR/xml/#charsets
-INVALID_CHARS = (
+INVALID_CHARS = frozenset(
     set().union(range(0x0, 0x9)).union(range(0xB, 0xE)).union(range(0xE, 0x20))
 )
 
+# characters used to build the prefixes for sharded listings
+SHARD_PREFIX_CHARS = "".join(
+    chr(i) for i in range(256) if i not in INVALID_CHARS and i != ord("/")
+)
+
 ESCAPED_COLON = "___COLON___"
 
+# scandir with shard_prefix_length only makes the sharded queries if a normal listing
+# has more than this many entries
+SHARDED_LISTING_PROBE_SIZE = 1000
+
+# rmtree lists entries ahead of the deletes, this is about two pages of an azure listing
+# or ten pages of a gcs listing
+RMTREE_PREFETCH_ENTRIES = 10000
+
+# default buffer_size for streaming reads and writes of remote files, every refill of a
+# small buffer costs a trip through the python-level read path
+DEFAULT_REMOTE_BUFFER_SIZE = 2 ** 20
+
+# characters that urljoin() treats specially, either as delimiters or by stripping them
+_URLJOIN_SPECIAL_CHARS = frozenset("?#;:" + "".join(chr(i) for i in range(0x21)))
+
 
 _context = Context()
 
+# directory for the local copies of remote files opened with streaming=False, created once
+# per process instead of once per file
+_temp_dir: Optional[str] = None
+_temp_dir_pid: Optional[int] = None
+_temp_dir_lock = threading.Lock()
+_temp_dir_cleanup_registered = False
+
 
 def configure(
     *,
@@ -78,6 +111,7 @@ def configure(
     # https://docs.microsoft.com/en-us/rest/api/storageservices/understanding-block-blobs--append-blobs--and-page-blobs#about-block-blobs
     # the chunk size determines the maximum size of an individual blob
     azure_write_chunk_size: int = common.DEFAULT_AZURE_WRITE_CHUNK_SIZE,
+    azure_upload_concurrency: int = common.DEFAULT_AZURE_UPLOAD_CONCURRENCY,
     google_write_chunk_size: int = common.DEFAULT_GOOGLE_WRITE_CHUNK_SIZE,
     retry_log_threshold: int = common.DEFAULT_RETRY_LOG_THRESHOLD,
     retry_limit: Optional[int] = None,
@@ -85,18 +119,27 @@ def configure(
     read_timeout: Optional[int] = common.DEFAULT_READ_TIMEOUT,
     output_az_paths: bool = False,
     use_azure_storage_account_key_fallback: bool = True,
+    metadata_cache_size: int = common.DEFAULT_METADATA_CACHE_SIZE,
+    metadata_cache_ttl: Optional[float] = None,
+    read_concurrency: int = common.DEFAULT_READ_CONCURRENCY,
+    parallel_read_chunk_size: int = common.DEFAULT_PARALLEL_READ_CHUNK_SIZE,
 ) -> None:
     """
     log_callback: a log callback function `log(msg: string)` to use instead of printing to stdout
     connection_pool_max_size: the max size for each per-host connection pool
     max_connection_pool_count: the maximum count of per-host connection pools
     azure_write_chunk_size: the size of blocks to write to Azure Storage blobs, can be set to a maximum of 100MB
+    azure_upload_concurrency: the number of blocks a streaming write to Azure Storage can upload at the same time, each block in flight keeps `azure_write_chunk_size` bytes in memory, set to 1 to upload blocks one at a time
     google_write_chunk_size: the size of blocks to write to Google Cloud Storage blobs in bytes, this only determines the unit of request retries
     retry_log_threshold: set a retry count threshold above which to log failures to the log callback function
     connect_timeout: the maximum amount of time (in seconds) to wait for a connection attempt to a server to succeed, set to None to wait forever
     read_timeout: the maximum amount of time (in seconds) to wait between consecutive read operations for a response from the server, set to None to wait forever
     output_az_paths: output `az://` paths instead of using the `https://` for azure
     use_azure_storage_account_key_fallback: fallback to storage account keys for azure containers, having this enabled (the default) requires listing your subscriptions and may run into 429 errors if you hit the low azure quotas for subscription listing
+    metadata_cache_size: the number of remote `stat()` results (including missing paths) to keep in memory, so that repeated calls to `exists()`, `stat()`, `md5()` or `BlobFile()` on a path do not each make a request, blobfile clears entries for paths that it modifies but will not see changes made by other processes, set to 0 (the default) to disable the cache
+    metadata_cache_ttl: the number of seconds that an entry in the metadata cache is used for before the path is checked again, this limits how long changes made by other processes go unseen, set to None (the default) to keep entries until they are evicted or the path is modified through blobfile
+    read_concurrency: the number of ranged requests a streaming read from blob storage can make at the same time, when greater than 1 the file is read in chunks of `parallel_read_chunk_size` and up to this many chunks at and ahead of the current offset are requested at once, set to 1 (the default) to read over a single connection
+    parallel_read_chunk_size: the size in bytes of each ranged request made when `read_concurrency` is greater than 1
     """
     global _context
     _context = Context(
@@ -104,6 +147,7 @@ def configure(
         connection_pool_max_size=connection_pool_max_size,
         max_connection_pool_count=max_connection_pool_count,
         azure_write_chunk_size=azure_write_chunk_size,
+        azure_upload_concurrency=azure_upload_concurrency,
         retry_log_threshold=retry_log_threshold,
         retry_limit=retry_limit,
         google_write_chunk_size=google_write_chunk_size,
@@ -111,26 +155,43 @@ def configure(
         read_timeout=read_timeout,
         output_az_paths=output_az_paths,
         use_azure_storage_account_key_fallback=use_azure_storage_account_key_fallback,
+        metadata_cache_size=metadata_cache_size,
+        metadata_cache_ttl=metadata_cache_ttl,
+        read_concurrency=read_concurrency,
+        parallel_read_chunk_size=parallel_read_chunk_size,
     )
 
 
+# each path is usually checked against several backends in a row, and urlparse is
+# relatively slow when listing or globbing many paths
+@functools.lru_cache(maxsize=1024)
+def _parse_scheme_and_netloc(path: str) -> Tuple[str, str]:
+    url = urllib.parse.urlsplit(path)
+    return url.scheme, url.netloc
+
+
+def _get_scheme_and_netloc(path: str) -> Tuple[str, str]:
+    if ":" not in path:
+        # a url scheme must be followed by a colon, this skips parsing for most local paths
+        return "", ""
+    return _parse_scheme_and_netloc(path)
+
+
 def _is_gcp_path(path: str) -> bool:
-    url = urllib.parse.urlparse(path)
-    return url.scheme == "gs"
+    scheme, _ = _get_scheme_and_netloc(path)
+    return scheme == "gs"
 
 
 def _is_azure_path(path: str) -> bool:
-    url = urllib.parse.urlparse(path)
+    scheme, netloc = _get_scheme_and_netloc(path)
     return (
-        url.scheme == "https" and url.netloc.endswith(".blob.core.windows.net")
-    ) or url.scheme == "az"
+        scheme == "https" and netloc.endswith(".blob.core.windows.net")
+    ) or scheme == "az"
 
 
 def _is_aws_path(path: str) -> bool:
-    url = urllib.parse.urlparse(path)
-    return (
-        url.scheme == "https" and url.netloc.endswith(".amazonaws.com")
-    ) or url.scheme == "s3"
+    scheme, netloc = _get_scheme_and_netloc(path)
+    return (scheme == "https" and netloc.endswith(".amazonaws.com")) or scheme == "s3"
 
 
 def _get_module(path: str) -> Optional[ModuleType]:
@@ -210,6 +271,29 @@ def _parallel_download(
             return binascii.hexlify(common.block_md5(f)).decode("utf8")
 
 
+def _local_copyfile(src: str, dst: str) -> None:
+    # copy_file_range() copies inside the kernel and can share extents on filesystems that
+    # support reflinks, shutil.copyfile() is used when it is unavailable or unsupported
+    # for this pair of files
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as src_f, open(dst, "wb") as dst_f:
+                size = os.fstat(src_f.fileno()).st_size
+                copied = 0
+                while True:
+                    n = os.copy_file_range(src_f.fileno(), dst_f.fileno(), 2 ** 30)
+                    if n == 0:
+                        break
+                    copied += n
+            # some filesystems, such as procfs and some fuse or network filesystems, return 0
+            # without copying anything, so only trust the result if it copied the whole file
+            if copied == size:
+                return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
 def copy(
     src: str,
     dst: str,
@@ -232,7 +316,8 @@ def copy(
     If `parallel_executor` is set to a `concurrent.futures.Executor` and `parallel` is set to `True`, the provided executor will be used instead of creating a new one for each call to `copy()`.
 
     If `return_md5` is set to `True`, an md5 will be calculated during the copy and returned if available,
-    or else None will be returned.
+    or else None will be returned.  When both paths are local, the md5 is calculated by reading `src` while
+    it is being copied, so if `src` is modified during the copy, the md5 may not match the contents of `dst`.
     """
     # it would be best to check isdir() for remote paths, but that would
     # involve 2 extra network requests, so just do this test instead
@@ -251,25 +336,25 @@ def copy(
     if _is_gcp_path(src) and _is_gcp_path(dst):
         srcbucket, srcname = gcp.split_path(src)
         dstbucket, dstname = gcp.split_path(dst)
+        url = gcp.build_url(
+            "/storage/v1/b/{sourceBucket}/o/{sourceObject}/rewriteTo/b/{destinationBucket}/o/{destinationObject}",
+            sourceBucket=srcbucket,
+            sourceObject=srcname,
+            destinationBucket=dstbucket,
+            destinationObject=dstname,
+        )
         params = {}
         while True:
             req = Request(
-                url=gcp.build_url(
-                    "/storage/v1/b/{sourceBucket}/o/{sourceObject}/rewriteTo/b/{destinationBucket}/o/{destinationObject}",
-                    sourceBucket=srcbucket,
-                    sourceObject=srcname,
-                    destinationBucket=dstbucket,
-                    destinationObject=dstname,
-                ),
-                method="POST",
-                params=params,
-                success_codes=(200, 404),
+                url=url, method="POST", params=params, success_codes=(200, 404)
             )
             resp = gcp.execute_api_request(_context, req)
             if resp.status == 404:
                 raise FileNotFoundError(f"Source file not found: '{src}'")
-            result = json.loads(resp.data)
+            result = common.json_loads(resp.data)
             if result["done"]:
+                # the response includes the new object resource
+                gcp.cache_stat(_context, dst, gcp.make_stat(result["resource"]))
                 if return_md5:
                     return gcp.get_md5(result["resource"])
                 else:
@@ -347,6 +432,7 @@ def copy(
                 raise Error("Copy id mismatch")
             etag = resp.headers["etag"]
             copy_status = resp.headers["x-ms-copy-status"]
+        azure.invalidate_stat(_context, dst)
         if copy_status != "success":
             raise Error(f"Invalid copy status: '{copy_status}'")
         if return_md5:
@@ -381,19 +467,66 @@ def copy(
                     _context, parallel_executor, src, dst, return_md5=return_md5
                 )
 
+    if _is_local_path(src) and _is_local_path(dst):
+        # let the operating system copy the file, if the md5 is requested, hash the source
+        # on another thread while the copy is in progress
+        if dirname(dst) != "":
+            makedirs(dirname(dst))
+        if return_md5:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                md5_future = executor.submit(md5, src)
+                _local_copyfile(src, dst)
+                return md5_future.result()
+        _local_copyfile(src, dst)
+        return
+
+    if (
+        _is_local_path(src)
+        and _is_gcp_path(dst)
+        and os.path.getsize(src) <= _context.google_write_chunk_size
+    ):
+        # a file that fits in a single chunk of a resumable upload can be uploaded
+        # without creating an upload session
+        md5_digest = gcp.upload_file(_context, src, dst)
+        return md5_digest if return_md5 else None
+
     for attempt, backoff in enumerate(common.exponential_sleep_generator()):
         try:
             with BlobFile(src, "rb", streaming=True) as src_f, BlobFile(
                 dst, "wb", streaming=True
             ) as dst_f:
                 m = hashlib.md5()
-                while True:
-                    block = src_f.read(CHUNK_SIZE)
-                    if block == b"":
-                        break
+                block_size = common.get_read_block_size(_context)
+
+                def write_block(block: memoryview) -> int:
+                    # hashing releases the GIL for large blocks, so doing it here also
+                    # overlaps it with reading the next block
                     if return_md5:
                         m.update(block)
-                    dst_f.write(block)
+                    return dst_f.write(block)
+
+                # write from a separate thread so that reading the next block overlaps
+                # with uploading the previous one, a single worker keeps the writes in order
+                with concurrent.futures.ThreadPoolExecutor(max_workers=1) as writer:
+                    pending: collections.deque[
+                        Tuple[concurrent.futures.Future[int], bytearray]
+                    ] = collections.deque()
+                    # reuse a buffer once its block has been written instead of allocating
+                    # a new block for every read
+                    free_bufs: List[bytearray] = []
+                    while True:
+                        buf = free_bufs.pop() if free_bufs else bytearray(block_size)
+                        n = src_f.readinto(buf)
+                        if n == 0:
+                            break
+                        block = memoryview(buf)[:n]
+                        if len(pending) >= common.COPY_WRITE_BEHIND_BLOCKS:
+                            future, written_buf = pending.popleft()
+                            future.result()
+                            free_bufs.append(written_buf)
+                        pending.append((writer.submit(write_block, block), buf))
+                    for future, _ in pending:
+                        future.result()
                 if return_md5:
                     return m.hexdigest()
                 else:
@@ -424,7 +557,7 @@ def _create_gcp_page_iterator(
         resp = gcp.execute_api_request(_context, req)
         if resp.status == 404:
             return
-        result = json.loads(resp.data)
+        result = common.json_loads(resp.data)
         yield result
         if "nextPageToken" not in result:
             break
@@ -435,38 +568,36 @@ def _gcp_get_entries(bucket: str, result: Mapping[str, Any]) -> Iterator[DirEntr
     if "prefixes" in result:
         for p in result["prefixes"]:
             path = gcp.combine_path(bucket, p)
-            yield _entry_from_dirpath(path)
+            yield _entry_from_dirpath(path, name=_blob_basename(p))
     if "items" in result:
         for item in result["items"]:
             path = gcp.combine_path(bucket, item["name"])
+            # listings return the same object resource as a get, so save a request
+            # if the caller stats one of these paths afterward
+            st = gcp.make_stat(item)
+            gcp.cache_stat(_context, path, st)
+            name = _blob_basename(item["name"])
             if item["name"].endswith("/"):
-                yield _entry_from_dirpath(path)
+                yield _entry_from_dirpath(path, name=name)
             else:
-                yield _entry_from_path_stat(path, gcp.make_stat(item))
+                yield _entry_from_path_stat(path, st, name=name)
 
 
 def _azure_get_entries(
     account: str, container: str, result: Mapping[str, Any]
 ) -> Iterator[DirEntry]:
     blobs = result["Blobs"]
-    if blobs is None:
-        return
-    if "BlobPrefix" in blobs:
-        if isinstance(blobs["BlobPrefix"], dict):
-            blobs["BlobPrefix"] = [blobs["BlobPrefix"]]
-        for bp in blobs["BlobPrefix"]:
-            path = azure.combine_path(_context, account, container, bp["Name"])
-            yield _entry_from_dirpath(path)
-    if "Blob" in blobs:
-        if isinstance(blobs["Blob"], dict):
-            blobs["Blob"] = [blobs["Blob"]]
-        for b in blobs["Blob"]:
-            path = azure.combine_path(_context, account, container, b["Name"])
-            if b["Name"].endswith("/"):
-                yield _entry_from_dirpath(path)
-            else:
-                props = b["Properties"]
-                yield _entry_from_path_stat(path, azure.make_stat(props))
+    for bp in blobs["BlobPrefix"]:
+        path = azure.combine_path(_context, account, container, bp["Name"])
+        yield _entry_from_dirpath(path, name=_blob_basename(bp["Name"]))
+    for b in blobs["Blob"]:
+        path = azure.combine_path(_context, account, container, b["Name"])
+        name = _blob_basename(b["Name"])
+        if b["Name"].endswith("/"):
+            yield _entry_from_dirpath(path, name=name)
+        else:
+            props = b["Properties"]
+            yield _entry_from_path_stat(path, azure.make_stat(props), name=name)
 
 
 def exists(path: str) -> bool:
@@ -476,20 +607,14 @@ def exists(path: str) -> bool:
     if _is_local_path(path):
         return os.path.exists(path)
     elif _is_gcp_path(path):
-        st = gcp.maybe_stat(_context, path)
-        if st is not None:
-            return True
-        return isdir(path)
+        return gcp.exists(_context, path)
     elif _is_aws_path(path):
         st = aws.maybe_stat(_context, path)
         if st is not None:
             return True
         return isdir(path)
     elif _is_azure_path(path):
-        st = azure.maybe_stat(_context, path)
-        if st is not None:
-            return True
-        return isdir(path)
+        return azure.exists(_context, path)
     else:
         raise Error(f"Unrecognized path: '{path}'")
 
@@ -525,30 +650,33 @@ def _split_path(path: str) -> List[str]:
     # a/b/c => a/, b/, c
     # a/b/ => a/, b/
     # /a/b/c => /, a/, b/, c
-    parts = []
-    part = ""
-    for c in path:
-        part += c
-        if c == "/":
-            parts.append(part)
-            part = ""
-    if part != "":
-        parts.append(part)
+    *dirs, last = path.split("/")
+    parts = [d + "/" for d in dirs]
+    if last != "":
+        parts.append(last)
     return parts
 
 
-def _entry_from_dirpath(path: str) -> DirEntry:
+def _blob_basename(blob: str) -> str:
+    # equivalent to basename() on the full path for a non-empty blob name, without having to
+    # parse the path again
+    return _strip_slash(blob).rpartition("/")[2]
+
+
+def _entry_from_dirpath(path: str, name: Optional[str] = None) -> DirEntry:
     path = _strip_slash(path)
-    return DirEntry(
-        name=basename(path), path=path, is_dir=True, is_file=False, stat=None
-    )
+    if name is None:
+        name = basename(path)
+    return DirEntry(name=name, path=path, is_dir=True, is_file=False, stat=None)
 
 
-def _entry_from_path_stat(path: str, stat: Stat) -> DirEntry:
+def _entry_from_path_stat(
+    path: str, stat: Stat, name: Optional[str] = None
+) -> DirEntry:
     assert not path.endswith("/")
-    return DirEntry(
-        name=basename(path), path=path, is_dir=False, is_file=True, stat=stat
-    )
+    if name is None:
+        name = basename(path)
+    return DirEntry(name=name, path=path, is_dir=False, is_file=True, stat=stat)
 
 
 def _expand_implicit_dirs(root: str, it: Iterator[DirEntry]) -> Iterator[DirEntry]:
@@ -575,7 +703,8 @@ def _expand_implicit_dirs(root: str, it: Iterator[DirEntry]) -> Iterator[DirEntr
         previous_path = entry_slash_path
 
 
-def _compile_pattern(s: str):
+@functools.lru_cache(maxsize=256)
+def _compile_pattern(s: str) -> Pattern[str]:
     tokens = [t for t in re.split("([*]+)", s) if t != ""]
     regexp = ""
     for tok in tokens:
@@ -585,17 +714,30 @@ def _compile_pattern(s: str):
             regexp += r".*"
         else:
             regexp += re.escape(tok)
-    return re.compile(regexp + r"/?$")
+    # use with fullmatch(), unlike "$" this does not also match before a trailing newline
+    return re.compile(regexp + r"/?")
+
+
+def _literal_suffixes(pattern: str) -> Tuple[str, str]:
+    # every path matched by _compile_pattern(pattern) ends with the text after the last
+    # wildcard, possibly followed by a slash, listings are already restricted to the text
+    # before the first wildcard, so this is a cheap way to reject most non-matching entries
+    # before running the regex
+    _, _, suffix = pattern.rpartition("*")
+    return suffix, suffix + "/"
 
 
 def _glob_full(pattern: str) -> Iterator[DirEntry]:
     prefix, _, _ = pattern.partition("*")
+    suffixes = _literal_suffixes(pattern)
 
     re_pattern = _compile_pattern(pattern)
 
     for entry in _expand_implicit_dirs(root=prefix, it=_list_blobs(path=prefix)):
         entry_slash_path = _get_slash_path(entry)
-        if bool(re_pattern.match(entry_slash_path)):
+        if not entry_slash_path.endswith(suffixes):
+            continue
+        if bool(re_pattern.fullmatch(entry_slash_path)):
             if entry_slash_path == prefix and entry.is_dir:
                 # we matched the parent directory
                 continue
@@ -625,6 +767,7 @@ def _process_glob_task(
             yield _GlobEntry(entry)
     elif "*" in cur:
         re_pattern = _compile_pattern(root + cur)
+        suffixes = _literal_suffixes(cur)
         prefix, _, _ = cur.partition("*")
         path = root + prefix
         for entry in _list_blobs(path=path, delimiter="/"):
@@ -633,7 +776,9 @@ def _process_glob_task(
             if entry_slash_path == path and entry.is_dir:
                 # we matched the parent directory
                 continue
-            if bool(re_pattern.match(entry_slash_path)):
+            if not entry_slash_path.endswith(suffixes):
+                continue
+            if bool(re_pattern.fullmatch(entry_slash_path)):
                 if len(rem) == 0:
                     yield _GlobEntry(entry)
                 else:
@@ -812,13 +957,9 @@ def _guess_isdir(path: str) -> bool:
     """
     Guess if a path is a directory without performing network requests
     """
-    if _is_local_path(path) and os.path.isdir(path):
-        return True
-    elif (
-        _is_gcp_path(path) or _is_azure_path(path) or _is_aws_path(path)
-    ) and path.endswith("/"):
-        return True
-    return False
+    if _get_module(path) is None:
+        return os.path.isdir(path)
+    return path.endswith("/")
 
 
 def _aws_list_blobs(path: str, delimiter: Optional[str] = None) -> Iterator[DirEntry]:
@@ -834,7 +975,7 @@ def _gcp_list_blobs(path: str, delimiter: Optional[str] = None) -> Iterator[DirE
     it = _create_gcp_page_iterator(
         url=gcp.build_url("/storage/v1/b/{bucket}/o", bucket=bucket),
         method="GET",
-        params=dict(prefix=prefix, **params),
+        params=dict(prefix=prefix, fields=gcp.LIST_FIELDS, **params),
     )
     for result in it:
         for entry in _gcp_get_entries(bucket, result):
@@ -948,19 +1089,23 @@ def scandir(path: str, shard_prefix_length: int = 0) -> Iterator[DirEntry]:
     elif _is_gcp_path(path) or _is_azure_path(path) or _is_aws_path(path):
         if shard_prefix_length == 0:
             yield from _list_blobs_in_dir(path, exclude_prefix=True)
-        else:
-            prefixes = mp.Queue()
-            items = mp.Queue()
-            tasks_enqueued = 0
+            return
 
-            valid_chars = [
-                i for i in range(256) if i not in INVALID_CHARS and i != ord("/")
-            ]
+        # most prefixes are empty for a small directory, so only shard the listing if the
+        # directory does not fit in about one page of results
+        probe = list(
+            itertools.islice(
+                _list_blobs_in_dir(path, exclude_prefix=True),
+                SHARDED_LISTING_PROBE_SIZE + 1,
+            )
+        )
+        if len(probe) <= SHARDED_LISTING_PROBE_SIZE:
+            yield from probe
+        else:
+            tasks = []
             for repeat in range(1, shard_prefix_length + 1):
-                for chars in itertools.product(valid_chars, repeat=repeat):
-                    prefix = ""
-                    for c in chars:
-                        prefix += chr(c)
+                for chars in itertools.product(SHARD_PREFIX_CHARS, repeat=repeat):
+                    prefix = "".join(chars)
                     # we need to check for exact matches for shorter prefix lengths
                     # if we only searched for prefixes of length `shard_prefix_length`
                     # we would skip shorter names, for instance "a" would be skipped if we
@@ -968,19 +1113,22 @@ def scandir(path: str, shard_prefix_length: int = 0) -> Iterator[DirEntry]:
                     # instead we check for an exact match for everything shorter than
                     # our `shard_prefix_length`
                     exact = repeat != shard_prefix_length
-                    prefixes.put((path, prefix, exact))
-                    tasks_enqueued += 1
+                    tasks.append((path, prefix, exact))
 
-            tasks_done = 0
-            with mp.Pool(
-                initializer=_sharded_listdir_worker, initargs=(prefixes, items)
-            ):
-                while tasks_done < tasks_enqueued:
-                    entry = items.get()
-                    if entry is None:
-                        tasks_done += 1
-                        continue
-                    yield entry
+            # each query spends nearly all of its time waiting on the network, so use
+            # threads sharing the connection pool rather than processes
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=_context.connection_pool_max_size
+            )
+            futures = [executor.submit(_sharded_listdir_task, *t) for t in tasks]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    yield from future.result()
+            finally:
+                # if the caller stops iterating early, don't wait for the remaining queries
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=False)
     else:
         raise Error(f"Unrecognized path: '{path}'")
 
@@ -1015,21 +1163,11 @@ def _get_entry(path: str) -> Optional[DirEntry]:
     return None
 
 
-def _sharded_listdir_worker(
-    prefixes: mp.Queue[Tuple[str, str, bool]], items: mp.Queue[Optional[DirEntry]]
-) -> None:
-    while True:
-        base, prefix, exact = prefixes.get(True)
-        if exact:
-            path = base + prefix
-            entry = _get_entry(path)
-            if entry is not None:
-                items.put(entry)
-        else:
-            it = _list_blobs_in_dir(base + prefix, exclude_prefix=False)
-            for entry in it:
-                items.put(entry)
-        items.put(None)  # indicate that we have finished this path
+def _sharded_listdir_task(base: str, prefix: str, exact: bool) -> List[DirEntry]:
+    if exact:
+        entry = _get_entry(base + prefix)
+        return [] if entry is None else [entry]
+    return list(_list_blobs_in_dir(base + prefix, exclude_prefix=False))
 
 
 def makedirs(path: str) -> None:
@@ -1133,6 +1271,7 @@ def rmdir(path: str) -> None:
             success_codes=(204,),
         )
         gcp.execute_api_request(_context, req)
+        gcp.invalidate_stat(_context, path)
     elif _is_aws_path(path):
         raise NotImplementedError()
     elif _is_azure_path(path):
@@ -1145,6 +1284,7 @@ def rmdir(path: str) -> None:
             success_codes=(202,),
         )
         azure.execute_api_request(_context, req)
+        azure.invalidate_stat(_context, path)
     else:
         raise Error(f"Unrecognized path: '{path}'")
 
@@ -1203,6 +1343,7 @@ def set_mtime(path: str, mtime: float, version: Optional[str] = None) -> bool:
             success_codes=(200, 404, 412),
         )
         resp = gcp.execute_api_request(_context, req)
+        gcp.invalidate_stat(_context, path)
         if resp.status == 404:
             raise FileNotFoundError(f"No such file: '{path}'")
         return resp.status == 200
@@ -1242,6 +1383,7 @@ def set_mtime(path: str, mtime: float, version: Optional[str] = None) -> bool:
             success_codes=(200, 404, 412),
         )
         resp = azure.execute_api_request(_context, req)
+        azure.invalidate_stat(_context, path)
         if resp.status == 404:
             raise FileNotFoundError(f"No such file: '{path}'")
         return resp.status == 200
@@ -1249,6 +1391,66 @@ def set_mtime(path: str, mtime: float, version: Optional[str] = None) -> bool:
         raise Error(f"Unrecognized path: '{path}'")
 
 
+def _prefetch(it: Iterator[Any], maxsize: int) -> Iterator[Any]:
+    # consume the iterator on a background thread, keeping up to maxsize items ready, this lets
+    # a listing fetch its next page while the caller is still working on the current one
+    q: queue.Queue[Tuple[bool, Any]] = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item: Tuple[bool, Any]) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce() -> None:
+        try:
+            for item in it:
+                if not put((False, item)):
+                    return
+        except BaseException as e:
+            put((True, e))
+        else:
+            put((True, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            done, item = q.get()
+            if done:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        # if the caller stops iterating early, let the producer exit
+        stop.set()
+
+
+def _run_in_thread_pool(fn: Callable[[Any], None], it: Iterator[Any]) -> None:
+    # run fn on each item with one thread per connection in the pool, the iterator is consumed
+    # as the calls finish so that a large listing is never held in memory
+    max_workers = _context.connection_pool_max_size
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending: collections.deque[
+            concurrent.futures.Future[None]
+        ] = collections.deque()
+        try:
+            for item in it:
+                if len(pending) >= 2 * max_workers:
+                    pending.popleft().result()
+                pending.append(executor.submit(fn, item))
+            for future in pending:
+                future.result()
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+
 def rmtree(path: str) -> None:
     """
     Delete a directory tree
@@ -1262,29 +1464,36 @@ def rmtree(path: str) -> None:
         if not path.endswith("/"):
             path += "/"
         bucket, blob = gcp.split_path(path)
-        for entry in _gcp_list_blobs(path):
+        # the bucket part of the url is the same for every entry, so only quote the object name
+        url_prefix = gcp.build_url("/storage/v1/b/{bucket}/o/", bucket=bucket)
+
+        def delete_gcp_entry(entry: DirEntry) -> None:
             entry_slash_path = _get_slash_path(entry)
             entry_bucket, entry_blob = gcp.split_path(entry_slash_path)
             assert entry_bucket == bucket and entry_blob.startswith(blob)
             req = Request(
-                url=gcp.build_url(
-                    "/storage/v1/b/{bucket}/o/{object}",
-                    bucket=bucket,
-                    object=entry_blob,
-                ),
+                url=url_prefix + urllib.parse.quote(entry_blob, safe=""),
                 method="DELETE",
                 # 404 is allowed in case a failed request successfully deleted the file
                 # before erroring out
                 success_codes=(204, 404),
             )
             gcp.execute_api_request(_context, req)
+            gcp.invalidate_stat(_context, entry_slash_path)
+
+        _run_in_thread_pool(
+            delete_gcp_entry, _prefetch(_gcp_list_blobs(path), RMTREE_PREFETCH_ENTRIES)
+        )
     elif _is_aws_path(path):
         raise NotImplementedError()
     elif _is_azure_path(path):
         if not path.endswith("/"):
             path += "/"
         account, container, blob = azure.split_path(path)
-        for entry in _azure_list_blobs(path):
+        # the container part of the url is the same for every entry, so only quote the blob name
+        url_prefix = azure.build_url(account, "/{container}/", container=container)
+
+        def delete_azure_entry(entry: DirEntry) -> None:
             entry_slash_path = _get_slash_path(entry)
             entry_account, entry_container, entry_blob = azure.split_path(
                 entry_slash_path
@@ -1295,15 +1504,19 @@ def rmtree(path: str) -> None:
                 and entry_blob.startswith(blob)
             )
             req = Request(
-                url=azure.build_url(
-                    account, "/{container}/{blob}", container=container, blob=entry_blob
-                ),
+                url=url_prefix + urllib.parse.quote(entry_blob, safe=""),
                 method="DELETE",
                 # 404 is allowed in case a failed request successfully deleted the file
                 # before erroring out
                 success_codes=(202, 404),
             )
             azure.execute_api_request(_context, req)
+            azure.invalidate_stat(_context, entry_slash_path)
+
+        _run_in_thread_pool(
+            delete_azure_entry,
+            _prefetch(_azure_list_blobs(path), RMTREE_PREFETCH_ENTRIES),
+        )
     else:
         raise Error(f"Unrecognized path: '{path}'")
 
@@ -1331,10 +1544,8 @@ def walk(
         if not top.endswith("/"):
             top += "/"
         if topdown:
-            dq: collections.deque[str] = collections.deque()
-            dq.append(top)
-            while len(dq) > 0:
-                cur = dq.popleft()
+
+            def list_dir(cur: str) -> Tuple[List[str], List[str]]:
                 assert cur.endswith("/")
                 if _is_gcp_path(top):
                     it = _gcp_list_blobs(cur, delimiter="/")
@@ -1344,18 +1555,44 @@ def walk(
                     it = _azure_list_blobs(cur, delimiter="/")
                 else:
                     raise Error(f"Unrecognized path: '{top}'")
-                dirnames = []
-                filenames = []
+                dirnames: List[str] = []
+                filenames: List[str] = []
+                # single pass over the listing with the appends bound locally, only directory
+                # entries can be the marker for cur itself
+                append_dirname = dirnames.append
+                append_filename = filenames.append
                 for entry in it:
-                    entry_path = _get_slash_path(entry)
-                    if entry_path == cur:
-                        continue
                     if entry.is_dir:
-                        dirnames.append(entry.name)
+                        if entry.path + "/" != cur:
+                            append_dirname(entry.name)
                     else:
-                        filenames.append(entry.name)
-                yield (_strip_slash(cur), dirnames, filenames)
-                dq.extend(join(cur, dirname) + "/" for dirname in dirnames)
+                        append_filename(entry.name)
+                return dirnames, filenames
+
+            # directories are still yielded in breadth-first order, but the listings of all
+            # queued directories are made concurrently, a directory's children are only
+            # queued after it has been yielded so that the caller can still remove entries
+            # from dirnames to skip them
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=_context.connection_pool_max_size
+            )
+            dq: collections.deque[
+                Tuple[str, concurrent.futures.Future[Tuple[List[str], List[str]]]]
+            ] = collections.deque()
+            dq.append((top, executor.submit(list_dir, top)))
+            try:
+                while len(dq) > 0:
+                    cur, future = dq.popleft()
+                    dirnames, filenames = future.result()
+                    yield (_strip_slash(cur), dirnames, filenames)
+                    for dirname in dirnames:
+                        path = join(cur, dirname) + "/"
+                        dq.append((path, executor.submit(list_dir, path)))
+            finally:
+                # if the caller stops iterating early, don't wait for the remaining listings
+                for _, future in dq:
+                    future.cancel()
+                executor.shutdown(wait=False)
         else:
             if _is_gcp_path(top):
                 it = _gcp_list_blobs(top)
@@ -1455,6 +1692,17 @@ def _safe_urljoin(a: str, b: str) -> str:
     # https://stackoverflow.com/questions/55202875/python-urllib-parse-urljoin-on-path-starting-with-numbers-and-colon
     if ESCAPED_COLON in b:
         raise Error(f"url cannot contain string '{ESCAPED_COLON}'")
+    # urljoin() is only needed for absolute or relative navigation, for the common case
+    # of appending a plain relative path to a directory, concatenation gives the same result
+    if b != "" and not b.startswith("/") and (a == "" or a.endswith("/")):
+        joined = a + b
+        if (
+            "//" not in joined
+            and _URLJOIN_SPECIAL_CHARS.isdisjoint(joined)
+            and "." not in joined.split("/")
+            and ".." not in joined.split("/")
+        ):
+            return joined
     escaped_b = b.replace(":", ESCAPED_COLON)
     joined = urllib.parse.urljoin(a, escaped_b)
     return joined.replace(ESCAPED_COLON, ":")
@@ -1538,7 +1786,9 @@ def md5(path: str) -> str:
 
         # this is probably a composite object, calculate the md5 and store it on the file if the file has not changed
         with BlobFile(path, "rb") as f:
-            result = common.block_md5(f).hex()
+            result = common.block_md5(
+                f, block_size=common.get_read_block_size(_context)
+            ).hex()
 
         assert st.version is not None
         gcp.maybe_update_md5(_context, path, st.version, result)
@@ -1554,7 +1804,9 @@ def md5(path: str) -> str:
         if h is None:
             # md5 is missing, calculate it and store it on file if the file has not changed
             with BlobFile(path, "rb") as f:
-                h = common.block_md5(f).hex()
+                h = common.block_md5(
+                    f, block_size=common.get_read_block_size(_context)
+                ).hex()
             assert st.version is not None
             azure.maybe_update_md5(_context, path, st.version, h)
         return h
@@ -1563,12 +1815,51 @@ def md5(path: str) -> str:
             return common.block_md5(f).hex()
 
 
+def _remove_temp_dir() -> None:
+    # atexit handlers are inherited by forked children, only remove the directory from the
+    # process that made it
+    temp_dir = _temp_dir
+    if temp_dir is not None and _temp_dir_pid == os.getpid():
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def _get_temp_path(filename: str) -> str:
+    global _temp_dir, _temp_dir_pid, _temp_dir_cleanup_registered
+    with _temp_dir_lock:
+        # make a new directory in a forked child, or if something like a tmp cleaner
+        # removed ours
+        if (
+            _temp_dir is None
+            or _temp_dir_pid != os.getpid()
+            or not os.path.isdir(_temp_dir)
+        ):
+            _temp_dir = tempfile.mkdtemp(prefix="blobfile-")
+            _temp_dir_pid = os.getpid()
+            if not _temp_dir_cleanup_registered:
+                # the handler looks up the current directory when it runs, so one
+                # registration covers any directory made later, including in forked children
+                atexit.register(_remove_temp_dir)
+                _temp_dir_cleanup_registered = True
+        temp_dir = _temp_dir
+    # keep the original name at the end of the path, shortened so that it stays within
+    # the usual 255 byte filename limit, dropping any partial character at the start
+    name = filename.encode("utf8", errors="surrogateescape")[-200:]
+    return join(temp_dir, f"{uuid.uuid4().hex}-{name.decode('utf8', errors='ignore')}")
+
+
+@functools.lru_cache(maxsize=4096)
+def _path_md5(path: str) -> str:
+    # name of the lock and temp files for a remote path in cache_dir, data loaders tend to
+    # open the same paths over and over
+    return hashlib.md5(path.encode("utf8")).hexdigest()
+
+
 @overload
 def BlobFile(
     path: str,
     mode: Literal["rb", "wb", "ab"],
     streaming: Optional[bool] = ...,
-    buffer_size: int = ...,
+    buffer_size: Optional[int] = ...,
     cache_dir: Optional[str] = ...,
 ) -> BinaryIO:
     ...
@@ -1579,7 +1870,7 @@ def BlobFile(
     path: str,
     mode: Literal["r", "w", "a"] = ...,
     streaming: Optional[bool] = ...,
-    buffer_size: int = ...,
+    buffer_size: Optional[int] = ...,
     cache_dir: Optional[str] = ...,
 ) -> TextIO:
     ...
@@ -1589,7 +1880,7 @@ def BlobFile(
     path: str,
     mode: Literal["r", "rb", "w", "wb", "a", "ab"] = "r",
     streaming: Optional[bool] = None,
-    buffer_size: int = io.DEFAULT_BUFFER_SIZE,
+    buffer_size: Optional[int] = None,
     cache_dir: Optional[str] = None,
 ):
     """
@@ -1605,9 +1896,9 @@ def BlobFile(
                 * Appending is not implemented.
             * `streaming=False`:
                 * Reading is done by downloading the remote file to a local file during the constructor.
-                * Writing is done by uploading the file on `close()` or during destruction.
+                * Writing is done to a local file, which is uploaded on `close()` or during destruction.  For Google Cloud Storage and Azure Storage, once a file that is written sequentially grows past the write chunk size (`google_write_chunk_size` or `azure_write_chunk_size`), it is uploaded while it is being written and the upload is finished on `close()`.
                 * Appending is done by downloading the file during construction and uploading on `close()` or during destruction.
-        buffer_size: number of bytes to buffer, this can potentially make reading more efficient.
+        buffer_size: number of bytes to buffer, this can potentially make reading more efficient.  Defaults to 1MiB for streaming remote files and `io.DEFAULT_BUFFER_SIZE` otherwise.
         cache_dir: a directory in which to cache files for reading, only valid if `streaming=False` and `mode` is in `"r", "rb"`.   You are reponsible for cleaning up the cache directory.
 
     Returns:
@@ -1616,10 +1907,19 @@ def BlobFile(
     if _guess_isdir(path):
         raise IsADirectoryError(f"Is a directory: '{path}'")
 
+    # the module for a remote path, or None for a local one
+    module = _get_module(path)
+
     if streaming is None:
         streaming = mode in ("r", "rb")
 
-    if _is_local_path(path) and "w" in mode:
+    if buffer_size is None:
+        if streaming and module is not None:
+            buffer_size = DEFAULT_REMOTE_BUFFER_SIZE
+        else:
+            buffer_size = io.DEFAULT_BUFFER_SIZE
+
+    if module is None and "w" in mode:
         # local filesystems require that intermediate directories exist, but this is not required by the
         # remote filesystems
         # for consistency, automatically create local intermediate directories
@@ -1631,38 +1931,19 @@ def BlobFile(
             raise Error(f"Invalid mode for streaming file: '{mode}'")
         if cache_dir is not None:
             raise Error("Cannot specify cache_dir for streaming files")
-        if _is_local_path(path):
+        if module is None:
             f = io.FileIO(path, mode=mode)
             if "r" in mode:
                 f = io.BufferedReader(f, buffer_size=buffer_size)
             else:
                 f = io.BufferedWriter(f, buffer_size=buffer_size)
-        elif _is_gcp_path(path):
-            if mode in ("w", "wb"):
-                f = gcp.StreamingWriteFile(_context, path)
-            elif mode in ("r", "rb"):
-                f = gcp.StreamingReadFile(_context, path)
-                f = io.BufferedReader(f, buffer_size=buffer_size)
-            else:
-                raise Error(f"Unsupported mode: '{mode}'")
-        elif _is_aws_path(path):
-            if mode in ("w", "wb"):
-                f = aws.StreamingWriteFile(_context, path)
-            elif mode in ("r", "rb"):
-                f = aws.StreamingReadFile(_context, path)
-                f = io.BufferedReader(f, buffer_size=buffer_size)
-            else:
-                raise Error(f"Unsupported mode: '{mode}'")
-        elif _is_azure_path(path):
-            if mode in ("w", "wb"):
-                f = azure.StreamingWriteFile(_context, path)
-            elif mode in ("r", "rb"):
-                f = azure.StreamingReadFile(_context, path)
-                f = io.BufferedReader(f, buffer_size=buffer_size)
-            else:
-                raise Error(f"Unsupported mode: '{mode}'")
+        elif mode in ("w", "wb"):
+            f = module.StreamingWriteFile(_context, path)
+        elif mode in ("r", "rb"):
+            f = module.StreamingReadFile(_context, path)
+            f = io.BufferedReader(f, buffer_size=buffer_size)
         else:
-            raise Error(f"Unrecognized path: '{path}'")
+            raise Error(f"Unsupported mode: '{mode}'")
 
         # this should be a protocol so we don't have to cast
         # but the standard library does not seem to have a file-like protocol
@@ -1685,7 +1966,7 @@ def BlobFile(
             return cast(TextIO, text_f)
     else:
         remote_path = None
-        tmp_dir = None
+        is_temp = False
         if mode not in ("w", "wb", "r", "rb", "a", "ab"):
             raise Error(f"Invalid mode: '{mode}'")
 
@@ -1695,66 +1976,54 @@ def BlobFile(
         local_filename = basename(path)
         if local_filename == "":
             local_filename = "local.tmp"
-        if _is_gcp_path(path) or _is_azure_path(path) or _is_aws_path(path):
+        if module is not None:
             remote_path = path
             if mode in ("a", "ab"):
-                tmp_dir = tempfile.mkdtemp()
-                local_path = join(tmp_dir, local_filename)
+                is_temp = True
+                local_path = _get_temp_path(local_filename)
                 if exists(remote_path):
                     copy(remote_path, local_path)
             elif mode in ("r", "rb"):
                 if cache_dir is None:
-                    tmp_dir = tempfile.mkdtemp()
-                    local_path = join(tmp_dir, local_filename)
+                    is_temp = True
+                    local_path = _get_temp_path(local_filename)
                     copy(remote_path, local_path)
                 else:
                     if not _is_local_path(cache_dir):
                         raise Error(f"cache_dir must be a local path: '{cache_dir}'")
-                    makedirs(cache_dir)
-                    path_md5 = hashlib.md5(path.encode("utf8")).hexdigest()
-                    lock_path = join(cache_dir, f"{path_md5}.lock")
-                    tmp_path = join(cache_dir, f"{path_md5}.tmp")
-                    with filelock.FileLock(lock_path):
-                        remote_version = ""
-                        # get some sort of consistent remote hash so we can check for a local file
-                        if _is_gcp_path(path):
-                            st = gcp.maybe_stat(_context, path)
-                            if st is None:
-                                raise FileNotFoundError(f"No such file: '{path}'")
-                            assert st.version is not None
-                            remote_version = st.version
-                            remote_hash = st.md5
-                        elif _is_aws_path(path):
-                            st = aws.maybe_stat(_context, path)
-                            if st is None:
-                                raise FileNotFoundError(f"No such file: '{path}'")
-                            assert st.version is not None
-                            remote_version = st.version
-                            remote_hash = st.md5
-                        elif _is_azure_path(path):
-                            # in the azure case the remote md5 may not exist
-                            # this duplicates some of md5() because we want more control
-                            st = azure.maybe_stat(_context, path)
-                            if st is None:
-                                raise FileNotFoundError(f"No such file: '{path}'")
-                            assert st.version is not None
-                            remote_version = st.version
-                            remote_hash = st.md5
-                        else:
-                            raise Error(f"Unrecognized path: '{path}'")
-
-                        perform_copy = False
-                        if remote_hash is None:
-                            # there is no remote md5, copy the file
-                            # and attempt to update the md5
-                            perform_copy = True
-                        else:
-                            expected_local_path = join(
-                                cache_dir, remote_hash, local_filename
-                            )
-                            perform_copy = not exists(expected_local_path)
-
-                        if perform_copy:
+                    path_md5 = _path_md5(path)
+                    # get some sort of consistent remote hash so we can check for a local file
+                    # in the azure case the remote md5 may not exist
+                    st = module.maybe_stat(_context, path)
+                    if st is None:
+                        raise FileNotFoundError(f"No such file: '{path}'")
+                    assert st.version is not None
+                    remote_version = st.version
+                    remote_hash = st.md5
+
+                    # cache_dir is a local path, so skip the remote path handling in join()
+                    expected_local_path = None
+                    if remote_hash is not None:
+                        expected_local_path = os.path.join(
+                            cache_dir, remote_hash, local_filename
+                        )
+                    if expected_local_path is not None and os.path.exists(
+                        expected_local_path
+                    ):
+                        # files in the cache are only created by renaming a complete
+                        # download, so a cache hit does not need to wait for the lock, and
+                        # is a single stat() since the directories must already exist
+                        local_path = expected_local_path
+                    else:
+                        # download without holding the lock so that other processes opening
+                        # this file are not blocked for the whole download, each download goes
+                        # to its own temp file and the lock is only held to move it into place
+                        os.makedirs(cache_dir, exist_ok=True)
+                        fd, tmp_path = tempfile.mkstemp(
+                            prefix=f"{path_md5}.", suffix=".tmp", dir=cache_dir
+                        )
+                        os.close(fd)
+                        try:
                             local_hexdigest = copy(
                                 remote_path, tmp_path, overwrite=True, return_md5=True
                             )
@@ -1762,42 +2031,32 @@ def BlobFile(
                             # the file we downloaded may not match the remote file because
                             # the remote file changed while we were downloading it
                             # in this case make sure we don't cache it under the wrong md5
-                            local_path = join(
-                                cache_dir, local_hexdigest, local_filename
-                            )
-                            os.makedirs(dirname(local_path), exist_ok=True)
-                            if os.path.exists(local_path):
-                                # the file is already here, nevermind
+                            local_dir = os.path.join(cache_dir, local_hexdigest)
+                            local_path = os.path.join(local_dir, local_filename)
+                            os.makedirs(local_dir, exist_ok=True)
+                            lock_path = os.path.join(cache_dir, f"{path_md5}.lock")
+                            with filelock.FileLock(lock_path):
+                                if os.path.exists(local_path):
+                                    # another process downloaded the file at the same time
+                                    os.remove(tmp_path)
+                                else:
+                                    os.replace(tmp_path, local_path)
+                        finally:
+                            if os.path.exists(tmp_path):
                                 os.remove(tmp_path)
-                            else:
-                                os.replace(tmp_path, local_path)
-
-                            if remote_hash is None:
-                                if _is_azure_path(path):
-                                    azure.maybe_update_md5(
-                                        _context, path, remote_version, local_hexdigest
-                                    )
-                                elif _is_gcp_path(path):
-                                    gcp.maybe_update_md5(
-                                        _context, path, remote_version, local_hexdigest
-                                    )
-                                elif _is_aws_path(path):
-                                    aws.maybe_update_md5(
-                                        _context, path, remote_version, local_hexdigest
-                                    )
-                        else:
-                            assert remote_hash is not None
-                            local_path = join(cache_dir, remote_hash, local_filename)
+
+                        if remote_hash is None:
+                            module.maybe_update_md5(
+                                _context, path, remote_version, local_hexdigest
+                            )
             else:
-                tmp_dir = tempfile.mkdtemp()
-                local_path = join(tmp_dir, local_filename)
-        elif _is_local_path(path):
-            local_path = path
+                is_temp = True
+                local_path = _get_temp_path(local_filename)
         else:
-            raise Error(f"Unrecognized path: '{path}'")
+            local_path = path
 
         f = _ProxyFile(
-            local_path=local_path, mode=mode, tmp_dir=tmp_dir, remote_path=remote_path
+            local_path=local_path, mode=mode, is_temp=is_temp, remote_path=remote_path
         )
         if "r" in mode:
             f = io.BufferedReader(f, buffer_size=buffer_size)
@@ -1812,31 +2071,110 @@ def BlobFile(
 
 
 class _ProxyFile(io.FileIO):
+    # if the constructor fails, there is nothing for close() to clean up
+    _closed = True
+
     def __init__(
         self,
         local_path: str,
         mode: 'Literal["r", "rb", "w", "wb", "a", "ab"]',
-        tmp_dir: Optional[str],
+        is_temp: bool,
         remote_path: Optional[str],
     ) -> None:
-        super().__init__(local_path, mode=mode)
+        opener: Optional[Callable[[str, int], int]] = None
+        short_lived_flag = getattr(os, "O_SHORT_LIVED", None)
+        if is_temp and short_lived_flag is not None:
+            # on windows, this creates the file with FILE_ATTRIBUTE_TEMPORARY so that the cache
+            # manager keeps it in memory if possible instead of writing it to disk
+            def short_lived_opener(path: str, flags: int) -> int:
+                return os.open(path, flags | short_lived_flag)
+
+            opener = short_lived_opener
+
+        super().__init__(local_path, mode=mode, opener=opener)
         self._mode = mode
-        self._tmp_dir = tmp_dir
+        self._is_temp = is_temp
         self._local_path = local_path
         self._remote_path = remote_path
+        # when a new remote file larger than a write chunk is written sequentially, upload it
+        # while it is being written rather than all at once on close(), smaller files and files
+        # that are written out of order are uploaded from the local file on close() instead
+        self._remote_f: Optional[common.BaseStreamingWriteFile] = None
+        self._remote_offset = 0
+        self._remote_chunk_size: Optional[int] = None
+        if remote_path is not None and mode in ("w", "wb"):
+            if _is_gcp_path(remote_path):
+                self._remote_chunk_size = _context.google_write_chunk_size
+            elif _is_azure_path(remote_path):
+                self._remote_chunk_size = _context.azure_write_chunk_size
         self._closed = False
 
+    def _stop_remote_upload(self) -> None:
+        self._remote_chunk_size = None
+        if self._remote_f is not None:
+            self._remote_f.discard()
+            self._remote_f = None
+
+    def _start_remote_upload(self) -> None:
+        assert self._remote_path is not None
+        if _is_gcp_path(self._remote_path):
+            self._remote_f = gcp.StreamingWriteFile(_context, self._remote_path)
+        else:
+            self._remote_f = azure.StreamingWriteFile(_context, self._remote_path)
+        # upload what has been written so far
+        with open(self._local_path, "rb") as f:
+            remaining = self._remote_offset
+            while remaining > 0:
+                block = f.read(min(remaining, CHUNK_SIZE))
+                assert len(block) > 0, "local file is shorter than expected"
+                self._remote_f.write(block)
+                remaining -= len(block)
+
+    def write(self, b: Any) -> Optional[int]:
+        n = super().write(b)
+        if self._remote_chunk_size is not None and n is not None:
+            self._remote_offset += n
+            try:
+                if self._remote_f is not None:
+                    self._remote_f.write(memoryview(b).cast("B")[:n])
+                elif self._remote_offset > self._remote_chunk_size:
+                    self._start_remote_upload()
+            except Exception as e:
+                _context.log_callback(
+                    f"error {e} when uploading to {self._remote_path} during write, the file will be uploaded on close instead"
+                )
+                self._stop_remote_upload()
+        return n
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+        offset = super().seek(pos, whence)
+        if offset != self._remote_offset:
+            self._stop_remote_upload()
+        return offset
+
+    def truncate(self, size: Optional[int] = None) -> int:
+        size = super().truncate(size)
+        if size != self._remote_offset:
+            self._stop_remote_upload()
+        return size
+
     def close(self) -> None:
-        if not hasattr(self, "_closed") or self._closed:
+        if self._closed:
             return
 
         super().close()
         try:
-            if self._remote_path is not None and self._mode in ("w", "wb", "a", "ab"):
+            if self._remote_f is not None:
+                self._remote_f.close()
+            elif self._remote_path is not None and self._mode in (
+                "w",
+                "wb",
+                "a",
+                "ab",
+            ):
                 copy(self._local_path, self._remote_path, overwrite=True)
         finally:
             # if the copy fails, still cleanup our local temp file so it is not leaked
-            if self._tmp_dir is not None:
+            if self._is_temp:
                 os.remove(self._local_path)
-                os.rmdir(self._tmp_dir)
         self._closed = True
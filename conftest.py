@@ -9,9 +9,22 @@ def pytest_addoption(parser):
 
 def pytest_configure(config):
     config.addinivalue_line("markers", "slow: mark test as slow to run")
+    config.addinivalue_line(
+        "markers", "xdist_group(name): run tests with the same group on one worker"
+    )
 
 
+@pytest.hookimpl(tryfirst=True)
 def pytest_collection_modifyitems(config, items):
+    # tests for a single backend run on the same worker, different backends run concurrently
+    for item in items:
+        callspec = getattr(item, "callspec", None)
+        if callspec is None:
+            continue
+        for name in ["ctx", "shared_corpus"]:
+            if name in callspec.params:
+                item.add_marker(pytest.mark.xdist_group(callspec.params[name].__name__))
+
     if config.getoption("--runslow"):
         # --runslow given in cli: do not skip slow tests
         return
@@ -2,4 +2,7 @@ import subprocess as sp
 import sys
 
 sp.run(["pip", "install", "-e", "."], check=True)
-sp.run(["pytest", "blobfile"] + sys.argv[1:], check=True)
+sp.run(
+    ["pytest", "--numprocesses=4", "--dist=loadgroup", "blobfile"] + sys.argv[1:],
+    check=True,
+)